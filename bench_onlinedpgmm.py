@@ -0,0 +1,111 @@
+"""micro-benchmarks of the onlinedpgmm hot paths
+
+python bench_onlinedpgmm.py --N 200 2000 --T 50 250 --dim 50 300 \
+        --output bench.jsonl
+
+every (kernel, mode, N, T, dim) case runs in a fresh worker process and
+writes one json line: seconds per call, throughput in points * topics / s
+and the peak resident memory the case added (kB).
+"""
+import sys, time, json, resource, argparse, subprocess
+import multiprocessing
+import numpy as np
+import onlinedpgmm
+
+modes = ['full', 'diagonal', 'spherical', 'semi-spherical']
+kernels = ['log_normalize', 'expect_log_sticks', 'diff_square', \
+    'E_log_gauss', 'add_to_sstats', 'update_par', 'update_model']
+
+def make_case(mode, N, T, dim, dtype):
+    np.random.seed(0)
+    X = np.random.randn(N, dim)
+    prior_x0 = (1, 100) if mode == 'semi-spherical' else None
+    dp = onlinedpgmm.OnlineDP(T, 1.0, 0.6, 1, 100 * N, dim, mode, dtype)
+    dp.init_par(init_mean=X.copy(), init_cov=1.0, prior_x0=prior_x0)
+    z = np.random.dirichlet(np.ones(T), N).astype(dtype)
+    ss = onlinedpgmm.SuffStats(T, dim, mode)
+    dp.add_to_sstats(z, z, X, ss)
+    return dp, X, z, ss
+
+def kernel_call(kernel, dp, X, z, ss):
+    """a no-argument function running kernel once"""
+    if kernel == 'log_normalize':
+        elg = dp.E_log_gauss(X)
+        return lambda: onlinedpgmm.log_normalize(elg)
+    if kernel == 'expect_log_sticks':
+        return lambda: onlinedpgmm.expect_log_sticks(dp.var_stick)
+    if kernel == 'diff_square':
+        return lambda: dp.diff_square(X)
+    if kernel == 'E_log_gauss':
+        return lambda: dp.E_log_gauss(X)
+    if kernel == 'add_to_sstats':
+        buf = {}
+        return lambda: dp.add_to_sstats(z, z, X, ss.reset(), buf)
+    if kernel == 'update_par':
+        return lambda: dp.update_par(dp.var_x2, dp.var_x1, dp.var_x0)
+    if kernel == 'update_model':
+        return lambda: dp.update_model(ss)
+    raise ValueError('unknown kernel %s' % kernel)
+
+def run_case(case):
+    """time one case, called in a worker process"""
+    kernel, mode, N, T, dim, dtype, repeat = case
+    dp, X, z, ss = make_case(mode, N, T, dim, dtype)
+    call = kernel_call(kernel, dp, X, z, ss)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    call() # warm up
+    times = []
+    for i in range(repeat):
+        start = time.time()
+        call()
+        times.append(time.time() - start)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss
+    best = min(times)
+    return {'kernel': kernel, 'mode': mode, 'N': N, 'T': T, 'dim': dim,
+        'dtype': np.dtype(dtype).name, 'repeat': repeat,
+        'best_s': best, 'mean_s': sum(times) / len(times),
+        'throughput': N * T / best if best > 0 else float('inf'),
+        'peak_kb': peak}
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], \
+            stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='onlinedpgmm benchmarks')
+    parser.add_argument('--kernels', nargs='+', default=kernels)
+    parser.add_argument('--modes', nargs='+', default=modes)
+    parser.add_argument('--N', nargs='+', type=int, default=[2000])
+    parser.add_argument('--T', nargs='+', type=int, default=[250])
+    parser.add_argument('--dim', nargs='+', type=int, default=[50])
+    parser.add_argument('--dtype', default='float64')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, \
+        help='append json lines here instead of stdout')
+    args = parser.parse_args(argv)
+
+    rev = git_revision()
+    out = sys.stdout if args.output is None else open(args.output, 'a')
+    # a fresh process per case, so peak memory is not shared between cases
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    for mode in args.modes:
+        for N in args.N:
+            for T in args.T:
+                for dim in args.dim:
+                    for kernel in args.kernels:
+                        case = (kernel, mode, N, T, dim, args.dtype, \
+                            args.repeat)
+                        result = pool.apply(run_case, (case,))
+                        result['revision'] = rev
+                        out.write(json.dumps(result, sort_keys=True) + '\n')
+                        out.flush()
+    pool.close()
+    pool.join()
+    if out is not sys.stdout:
+        out.close()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
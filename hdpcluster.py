@@ -40,10 +40,11 @@ def hdpcluster():
     topics = []
     X = []
     Ys = []
+    predictor = hdp.freeze(groups, 2)
     for group in groups:
         group.data.reset()
         topic, title, X = group.data.next_n_record(1000000)
-        Y = hdp.predict(X, group, 2).tolist()
+        Y = predictor.labels(X, group).tolist()
         #Y = hdp.predict(X).tolist()
         titles.extend(title)
         topics.extend(topic)
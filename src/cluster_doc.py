@@ -1,6 +1,5 @@
 import sys
 from collections import Counter
-import cPickle
 
 import numpy as np
 import model as md
@@ -57,11 +56,12 @@ for belief, variance in [
     ] * 3:
     base = md.FullFactorSpheGaussianMixture(500, dim, 1e-10, belief, variance * belief,  X, sheduler)
     base = md.DPMixture(500, 1, base, md.StickBreakingWeight(500, 1), md.DecaySheduler(100, 0.6, 0.000000001))
-    for i in range((X.shape[0] + batch_size - 1) / batch_size):
+    #batch = X[ np.random.choice(X.shape[0], batch_size, replace=True)]
+    batches = (X[i * batch_size:min((i+1) * batch_size, X.shape[0]), :]
+        for i in range((X.shape[0] + batch_size - 1) / batch_size))
+    for i, batch in enumerate(md.prefetch_batches(batches)):
         if (i + 1) % 100 == 0:
             print 'iteration: %d' % (i + 1)
-        #batch = X[ np.random.choice(X.shape[0], batch_size, replace=True)]
-        batch = X[i * batch_size:min((i+1) * batch_size, X.shape[0]), :]
         base.update(batch, 1e6)
     n = sum(np.exp(base.weight.logWeight())>=0.001)
     line = '{:e},{:e},{:d}\n'.format(belief, variance, n)
@@ -71,7 +71,7 @@ for belief, variance in [
     output.write(line)
     output.flush()
 sys.exit(0)
-cPickle.dump(base, open('base_model.pkl', 'w'))
+md.save_model(base, 'base_model.mix')
 
 tweight = np.exp(base.weight.logWeight())
 print sorted(tweight, reverse=True)
@@ -92,9 +92,9 @@ sys.exit(0)
 for i in range(100000):
     if (i + 1) % 100 == 0:
         print 'iteration: %d' % (i + 1)
-    for data, model in zip(groups, models):
-        batch = data[ np.random.choice(data.shape[0], batch_size, replace=True)]
-        model.update(batch, 1e6)
+    batches = [data[ np.random.choice(data.shape[0], batch_size, replace=True)]
+        for data, model in zip(groups, models)]
+    md.update_groups(models, batches, [1e6] * len(models))
 
 y = []
 for data, model in zip(groups, models):
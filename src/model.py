@@ -1,3 +1,8 @@
+import json
+import struct
+import sys
+import threading
+import Queue
 import numpy as np
 import scipy.special as sp
 
@@ -22,6 +27,53 @@ def choose_sample(X, size):
     idx = np.random.choice(n, size, replace=False)
     return X[idx,:]
 
+def prefetch_batches(batches, depth=2):
+    """
+    iterate over batches (any iterable) with a background thread
+    producing up to depth items ahead as contiguous arrays, so gathering
+    the next minibatch overlaps the update of the current one
+    """
+    queue = Queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def run():
+        try:
+            for batch in batches:
+                batch = np.ascontiguousarray(batch)
+                while not stop.is_set():
+                    try:
+                        queue.put(batch, timeout=0.1)
+                        break
+                    except Queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            item = done
+        except Exception:
+            item = sys.exc_info()
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item = queue.get()
+            if item is done:
+                return
+            if isinstance(item, tuple):
+                raise item[0], item[1], item[2]
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
 class StandardGaussianMixture(object):
     def __init__(self, K, dim, gamma0, lmbd, X, lrshdl):
         self.K = K
@@ -31,6 +83,7 @@ class StandardGaussianMixture(object):
         self.gamma = np.ones(K) * gamma0
         self.mu = choose_sample(X, K)
         self.lrshdl = lrshdl
+        self._updateCache()
 
     def update(self, X, scale, z):
         lr = self.lrshdl.nextRate()
@@ -38,19 +91,45 @@ class StandardGaussianMixture(object):
         stat1 = scale * np.dot(z.T, X)
         self.gamma = lr * (self.gamma0 + stat0) + (1 - lr) * self.gamma
         self.mu = lr * stat1 / self.gamma[:, np.newaxis] + (1.0 - lr) * self.mu
+        self._updateCache()
+
+    def keep(self, idx):
+        """keep only the components idx, in that order"""
+        self.gamma = self.gamma[idx]
+        self.mu = self.mu[idx]
+        self.K = len(self.gamma)
+        self._updateCache()
+
+    def grow(self, means):
+        """add components at means, each the posterior of the single
+        point there: gamma0 + 1
+        """
+        self.gamma = np.append(self.gamma, np.ones(means.shape[0]) * (self.gamma0 + 1))
+        self.mu = np.vstack([self.mu, means])
+        self.K = len(self.gamma)
+        self._updateCache()
+
+    def _updateCache(self):
+        """the per component terms of log_likelihood, call it after
+        changing mu or gamma
+        """
+        self.mu_sq = np.sum(np.square(self.mu), axis=1)
+        self.const = -0.5 * self.dim / self.gamma \
+            - 0.5 * self.lmbd * self.mu_sq \
+            - 0.5 * self.dim * np.log(2 * np.pi / self.lmbd)
 
-    def log_likelihood(self, X):
+    def log_likelihood(self, X, out=None):
         """
         Compute likelihood given data X
         :param X: n * dim matrix
+        :param out: optional n * k float64 array for the result
         :return: n * k matrix
         """
         sqX = np.sum(np.square(X), axis=1)
-        muX = np.sum(self.mu[np.newaxis, :, :] * X[:, np.newaxis, :], axis=2)
-        logprob = -0.5 * self.lmbd * sqX[:, np.newaxis] -0.5 * self.dim / self.gamma\
-            + self.lmbd * muX\
-            + 0.5 * self.lmbd * np.sum(np.square(self.mu), axis=1)[np.newaxis, :]\
-            - 0.5 * self.dim * np.log(2 * np.pi / self.lmbd)
+        logprob = np.dot(X, self.mu.T, out=out)
+        logprob *= self.lmbd
+        logprob -= 0.5 * self.lmbd * sqX[:, np.newaxis]
+        logprob += self.const[np.newaxis, :]
         return logprob
 
 class FullFactorSpheGaussianMixture(object):
@@ -88,21 +167,51 @@ class FullFactorSpheGaussianMixture(object):
 
         self._updateExpectation()
 
+    def keep(self, idx):
+        """keep only the components idx, in that order"""
+        self.gamma = self.gamma[idx]
+        self.nu = self.nu[idx]
+        self.a = self.a[idx]
+        self.b = self.b[idx]
+        self.K = len(self.gamma)
+        self._updateExpectation()
+
+    def grow(self, means):
+        """add components at means, each the posterior of the single
+        point there: gamma0 + 1, a0 + dim / 2 and, with no residual
+        around the point, b0
+        """
+        n = means.shape[0]
+        self.gamma = np.append(self.gamma, np.ones(n) * (self.gamma0 + 1))
+        self.nu = np.vstack([self.nu, means])
+        self.a = np.append(self.a, np.ones(n) * (self.a0 + 0.5 * self.dim))
+        self.b = np.append(self.b, np.ones(n) * self.b0)
+        self.K = len(self.gamma)
+        self._updateExpectation()
+
     def _updateExpectation(self):
         self.expc_mu = self.nu
         self.expc_lnlambda = sp.psi(self.a) - np.log(self.b) 
         self.expc_lambda = self.a / self.b
         self.expc_lambdasqmu = self.expc_lambda * np.sum(np.square(self.nu), axis=1)\
                + self.dim / self.gamma
+        ## the per component terms of log_likelihood
+        self.const = -0.5 * self.expc_lambdasqmu\
+            + 0.5 * self.dim * self.expc_lnlambda\
+            - 0.5 * self.dim * np.log(2 * np.pi)
 
-    def log_likelihood(self, X):
+    def log_likelihood(self, X, out=None):
+        """
+        :param X: n * dim matrix
+        :param out: optional n * k float64 array for the result
+        :return: n * k matrix
+        """
         sqX = np.sum(np.square(X), axis=1)
-        muX = np.sum(self.expc_mu[np.newaxis, :, :] * X[:, np.newaxis, :], axis=2)
-        logprob = -0.5 * self.expc_lambda * sqX[:, np.newaxis] \
-            + self.expc_lambda * muX\
-            + 0.5 * self.expc_lambdasqmu\
-            + 0.5 * self.dim * self.expc_lnlambda[np.newaxis, :]\
-            - 0.5 * self.dim * np.log(2 * np.pi)
+        # lambda * (mu X - 0.5 * sqX), in place
+        logprob = np.dot(X, self.expc_mu.T, out=out)
+        logprob -= 0.5 * sqX[:, np.newaxis]
+        logprob *= self.expc_lambda[np.newaxis, :]
+        logprob += self.const[np.newaxis, :]
         return logprob
 
     def entropy(self):
@@ -164,6 +273,31 @@ class StickBreakingWeight(object):
         self.sticks[1] = lr * stick1 + (1.0 - lr) * self.sticks[1]
         self._calcLogWeight()
 
+    def counts(self):
+        """the expected (scaled) number of points of each component the
+        sticks stand for
+        """
+        n = np.empty(self.K)
+        n[:-1] = self.sticks[0] - 1.0
+        n[-1] = self.sticks[1, -1] - self.alpha
+        return n
+
+    def setCounts(self, n):
+        """sticks from the counts of the components, K = len(n)"""
+        self.K = len(n)
+        self.sticks = np.zeros((2, self.K - 1))
+        self.sticks[0] = n[:-1] + 1.0
+        self.sticks[1] = np.flipud(np.cumsum(np.flipud(n[1:]))) + self.alpha
+        self._calcLogWeight()
+
+    def keep(self, idx):
+        """keep only the components idx, in that order"""
+        self.setCounts(self.counts()[idx])
+
+    def grow(self, n):
+        """add n empty components at the end"""
+        self.setCounts(np.append(self.counts(), np.zeros(n)))
+
     def entropy(self):
         a, b = self.sticks[0], self.sticks[1]
         ents = a - np.log(b) + sp.gammaln(a) + (1 - a)*sp.psi(a)
@@ -175,31 +309,107 @@ class StickBreakingWeight(object):
 
 class DPMixture(object):
     """Online DP model"""
+    ## growing truncation, see setGrowth
+    maxK = None
+    births = 1
+    birthThreshold = None
+    retireWeight = 1e-3
+
     def __init__(self, K, dim, model, weight, lrshdl):
         self.model = model
         self.weight = weight
         self.K = K
         self.lrshdl = lrshdl
 
-    def log_likelihood(self, X):
-        return self.model.log_likelihood(X) + self.weight.logWeight()
-
-    def assign(self, X):
-        logz = self.log_likelihood(X)
+    def setGrowth(self, maxK, births=1, threshold=None, retire=1e-3):
+        """
+        let update change K: before each update up to births components
+        are proposed at the batch points the mixture explains worst (log
+        evidence under threshold, any point if None), as long as
+        K < maxK, and kept if they take their own point over; after it
+        the components whose expected weight is under retire are
+        dropped. maxK = None turns it off. Updates with responsibilities
+        z given by the caller leave K alone, so a base shared by
+        SubDPMixtures keeps the K of their phi.
+        The model needs keep/grow (StandardGaussianMixture,
+        FullFactorSpheGaussianMixture), the weight a StickBreakingWeight.
+        """
+        if maxK is not None and not isinstance(self.weight, StickBreakingWeight):
+            raise ValueError("growing needs a StickBreakingWeight")
+        self.maxK = maxK
+        self.births = births
+        self.birthThreshold = threshold
+        self.retireWeight = retire
+
+    def _birth(self, X):
+        """add components at the worst explained points of X"""
+        n = min(self.births, self.maxK - self.K)
+        if n <= 0:
+            return
+        _, lognorm = log_normalize(self.log_likelihood(X))
+        worst = np.argsort(lognorm)[:n]
+        if self.birthThreshold is not None:
+            worst = worst[lognorm[worst] < self.birthThreshold]
+        if len(worst) == 0:
+            return
+        K, n = self.K, len(worst)
+        ## a posterior of its point, not the prior: with a tiny gamma0
+        ## the mean uncertainty dim / gamma0 would sink every newborn
+        self.model.grow(X[worst])
+        self.weight.grow(n)
+        # a newborn stays if it takes its own point over
+        z = self.assign(X[worst])
+        born = np.flatnonzero(z[np.arange(n), K + np.arange(n)] >= 0.5)
+        if len(born) < n:
+            keep = np.concatenate([np.arange(K), K + born])
+            self.model.keep(keep)
+            self.weight.keep(keep)
+        self.K = self.model.K
+
+    def _retire(self):
+        """drop the components with too little expected weight"""
+        alive = np.flatnonzero(np.exp(self.weight.logWeight()) >= self.retireWeight)
+        if len(alive) == self.K:
+            return
+        if len(alive) < 2:
+            # at least two components, the largest ones
+            alive = np.sort(np.argsort(self.weight.logWeight())[-2:])
+        self.model.keep(alive)
+        self.weight.keep(alive)
+        self.K = self.model.K
+
+    def log_likelihood(self, X, out=None):
+        """out: optional n * K float64 array for the result"""
+        logz = self.model.log_likelihood(X, out)
+        logz += self.weight.logWeight()
+        return logz
+
+    def assign(self, X, out=None):
+        """responsibilities of X, written into out if given"""
+        logz = self.log_likelihood(X, out)
         logz, _ = log_normalize(logz)
-        z = np.exp(logz)
+        z = np.exp(logz, out=logz)
         return z
 
-    def predict(self, X):
-        logz = self.model.log_likelihood(X) + self.weight.logWeight()
+    def predict(self, X, out=None):
+        logz = self.log_likelihood(X, out)
         return logz.argmax(axis=1)
 
-    def update(self, X, scale, z=None):
+    def update(self, X, scale, z=None, out=None):
         lr = self.lrshdl.nextRate()
+        ## a z of the caller (SubDPMixture) holds columns of the current
+        ## components, so K only changes with our own responsibilities
+        growing = z is None and self.maxK is not None
         if z is None:
-            z = self.assign(X)
+            if growing:
+                self._birth(X)
+            if out is not None and out.shape[1] != self.K:
+                out = None
+            z = self.assign(X, out)
         self.weight.update(z, scale, lr)
         self.model.update(X, scale, z=z)
+        if growing:
+            self._retire()
 
     def logLikelihood(self, X, scale):
         Eloggauss = self.model.log_likelihood(X)
@@ -241,8 +451,14 @@ class SubDPMixture(object):
         return z.argmax(axis=1)
 
     def update(self, X, scale, z=None):
+        newt = self.localUpdate(self.base.log_likelihood(X), scale)
+        self.base.update(X, scale, newt)
+
+    def localUpdate(self, logl, scale):
+        """update phi and the weights given the base log likelihood logl
+        of a batch, return the batch's responsibilities for the base
+        """
         lr = self.lrshdl.nextRate()
-        logl = self.base.log_likelihood(X)
         logk, _ = log_normalize(np.dot(logl, self.phi.T) + self.weight.logWeight())
         k = np.exp(logk)
         logphi, _ = log_normalize(np.dot(k.T, logl))
@@ -250,7 +466,7 @@ class SubDPMixture(object):
         newt = np.dot(k, self.phi)
         self.weight.update(k, scale, lr)
         self.phi = lr * newphi + (1 - lr) * self.phi
-        self.base.update(X, scale, newt)
+        return newt
 
 
     def logLikelihood(self, X, scale):
@@ -261,6 +477,32 @@ class SubDPMixture(object):
         return loglik
 
 
+def update_groups(models, batches, scales, base_scale=None):
+    """one training round of SubDPMixtures sharing a base: the base log
+    likelihood of all the batches in one pass, the local update of every
+    model, then a single base update on the stacked batches.
+    scales: the scale of each model's own update
+    base_scale: scale of the stacked batch in the base update, default
+        mean(scales) / len(models), the average of the groups' estimates
+    """
+    if len(models) != len(batches) or len(models) != len(scales):
+        raise ValueError("need one batch and one scale per model")
+    base = models[0].base
+    for m in models:
+        if m.base is not base:
+            raise ValueError("the models do not share one base")
+    if base_scale is None:
+        base_scale = np.mean(scales) / len(models)
+    X = np.vstack(batches)
+    logl = base.log_likelihood(X)
+    newt = []
+    start = 0
+    for m, x, scale in zip(models, batches, scales):
+        end = start + x.shape[0]
+        newt.append(m.localUpdate(logl[start:end], scale))
+        start = end
+    base.update(X, base_scale, np.vstack(newt))
+
 class DecaySheduler(object):
     def __init__(self, tau, kappa, minlr):
         ## for online learning
@@ -276,20 +518,114 @@ class DecaySheduler(object):
         self.count += 1
         return lr
 
+class ConvergenceMonitor(object):
+    def __init__(self, size=1000, tol=1e-4, patience=2, heldout=None,
+            reservoir=False):
+        """
+        scores the model on a subsample after every epoch of Trainer.fit
+        and tells when the score has stopped improving
+        size: number of rows scored
+        tol: relative improvement under which an epoch is a plateau
+        patience: plateaus in a row that stop the training
+        heldout: fixed rows to score, default size rows drawn from the
+            training data once per fit
+        reservoir: score a uniform reservoir of the rows trained on so
+            far instead
+        """
+        self.size = size
+        self.tol = tol
+        self.patience = patience
+        self.heldout = heldout
+        self.reservoir = reservoir
+        self.start(None)
+
+    def start(self, X):
+        """called by Trainer.fit before the first epoch"""
+        self.history = []
+        self.best = None
+        self.plateaus = 0
+        self.seen = 0
+        self.sample = self.heldout
+        if X is None or self.heldout is not None:
+            return
+        size = min(self.size, X.shape[0])
+        if self.reservoir:
+            self.sample = np.empty((size,) + X.shape[1:], X.dtype)
+        else:
+            self.sample = choose_sample(X, size)
+
+    def observe(self, x):
+        """feed a training minibatch to the reservoir"""
+        if not self.reservoir or self.heldout is not None:
+            return
+        size = self.sample.shape[0]
+        t = self.seen + np.arange(x.shape[0])
+        # algorithm R, later rows win like in the sequential version
+        j = np.where(t < size, t, (np.random.random(len(t)) * (t + 1)).astype(int))
+        keep = j < size
+        self.sample[j[keep]] = x[keep]
+        self.seen += x.shape[0]
+
+    def score(self, model, n):
+        """model.logLikelihood of the sample, for n rows of data"""
+        sample = self.sample
+        if self.reservoir and self.heldout is None:
+            sample = sample[:min(self.seen, sample.shape[0])]
+        return model.logLikelihood(sample, float(n) / sample.shape[0])
+
+    def update(self, model, n):
+        """score the model, return True when the training should stop"""
+        loglik = self.score(model, n)
+        self.history.append(loglik)
+        if self.best is not None \
+                and loglik - self.best <= self.tol * abs(self.best):
+            self.plateaus += 1
+        else:
+            self.plateaus = 0
+        if self.best is None or loglik > self.best:
+            self.best = loglik
+        return self.plateaus >= self.patience
+
 class Trainer(object):
-    def __init__(self, model, lrSheduler):
+    def __init__(self, model, lrSheduler=None):
+        """lrSheduler: replaces the model's own sheduler if given"""
         self.sheduler = lrSheduler
         self.model = model
-    def fit(self, X, n, split):
+        if lrSheduler is not None:
+            model.lrshdl = lrSheduler
+
+    def fit(self, X, n, split, monitor=None, shuffle=True, prefetch=0):
+        """
+        at most n epochs of split minibatches each
+        monitor: a ConvergenceMonitor scoring the epochs and stopping the
+            training early, default the full logLikelihood of X
+        shuffle: new minibatches every epoch
+        prefetch: gather up to this many minibatches ahead in a
+            background thread, see prefetch_batches
+        :return: the score of each epoch
+        """
         loglik = []
+        N = X.shape[0]
+        if monitor is not None:
+            monitor.start(X)
         for i in range(n):
-            step = (X.shape[0] + split - 1)/ split
-            for s in range(split):
-                start = s * step
-                end = min(start + step, X.shape[0])
-                x = X[start:end, ...]
-                self.model.update(x, split, self.sheduler.nextRate())
-            loglik.append(self.model.logLikelihood(X, 1))
+            order = np.random.permutation(N) if shuffle else np.arange(N)
+            step = (N + split - 1)/ split
+            batches = (X[order[s * step:min((s + 1) * step, N)], ...]
+                for s in range(split))
+            if prefetch > 0:
+                batches = prefetch_batches(batches, prefetch)
+            for x in batches:
+                if monitor is not None:
+                    monitor.observe(x)
+                self.model.update(x, split)
+            if monitor is None:
+                loglik.append(self.model.logLikelihood(X, 1))
+                continue
+            stop = monitor.update(self.model, N)
+            loglik.append(monitor.history[-1])
+            if stop:
+                break
         return loglik
 
 class NonBayesianWeight(object):
@@ -333,3 +669,122 @@ class ConstSheduler(object):
     def nextRate(self):
         return self.lr
 
+## the file format of save_model: magic, version, header length, json
+## header, then the arrays at multiples of model_align
+model_magic = 'MIXM'
+model_version = 1
+model_align = 64
+
+## attributes rebuilt by a method on load instead of being saved
+derived_state = {
+    'StandardGaussianMixture': ('_updateCache', ['mu_sq', 'const']),
+    'FullFactorSpheGaussianMixture': ('_updateExpectation',
+        ['expc_mu', 'expc_lnlambda', 'expc_lambda', 'expc_lambdasqmu', 'const']),
+    'StickBreakingWeight': ('_calcLogWeight', ['expc_logw']),
+}
+
+def _align(n):
+    return (n + model_align - 1) // model_align * model_align
+
+def _encode(obj, arrays, memo):
+    """json-able description of obj, its arrays are appended to arrays"""
+    if isinstance(obj, np.ndarray):
+        arrays.append(obj)
+        return {'array': len(arrays) - 1}
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if obj is None or isinstance(obj, (bool, int, long, float, basestring)):
+        return obj
+    if isinstance(obj, (list, tuple)):
+        return {'list': [_encode(o, arrays, memo) for o in obj]}
+    name = obj.__class__.__name__
+    if saved_classes.get(name) is not obj.__class__:
+        raise TypeError("can not save a %s" % name)
+    if id(obj) in memo:
+        # shared, e.g. the base of several SubDPMixtures
+        return {'ref': memo[id(obj)]}
+    memo[id(obj)] = len(memo)
+    skip = derived_state.get(name, (None, []))[1]
+    state = dict((k, _encode(v, arrays, memo))
+        for k, v in obj.__dict__.iteritems() if k not in skip)
+    return {'class': name, 'id': memo[id(obj)], 'state': state}
+
+def _decode(value, arrays, objs):
+    if isinstance(value, unicode):
+        return str(value)
+    if not isinstance(value, dict):
+        return value
+    if 'array' in value:
+        return arrays[value['array']]
+    if 'list' in value:
+        return [_decode(v, arrays, objs) for v in value['list']]
+    if 'ref' in value:
+        return objs[value['ref']]
+    name = str(value['class'])
+    cls = saved_classes[name]
+    obj = cls.__new__(cls)
+    objs[value['id']] = obj
+    for k, v in value['state'].iteritems():
+        setattr(obj, str(k), _decode(v, arrays, objs))
+    if name in derived_state:
+        getattr(obj, derived_state[name][0])()
+    return obj
+
+def save_model(obj, fname):
+    """
+    write a mixture (or a list of them, sharing parts) with its weights
+    and shedulers to fname: a small json header describing the objects,
+    then the raw parameter arrays, see load_model
+    """
+    arrays = []
+    root = _encode(obj, arrays, {})
+    specs = []
+    offset = 0
+    for i, a in enumerate(arrays):
+        a = np.ascontiguousarray(a, a.dtype.newbyteorder('<'))
+        arrays[i] = a
+        offset = _align(offset)
+        specs.append({'dtype': a.dtype.str, 'shape': a.shape, 'offset': offset})
+        offset += a.nbytes
+    header = json.dumps({'root': root, 'arrays': specs})
+    with open(fname, 'wb') as f:
+        f.write(struct.pack('<4sII', model_magic, model_version, len(header)))
+        f.write(header)
+        start = _align(f.tell())
+        for a, spec in zip(arrays, specs):
+            f.write('\0' * (start + spec['offset'] - f.tell()))
+            f.write(a.tobytes())
+
+def load_model(fname, mmap_mode='c'):
+    """
+    read what save_model wrote, the arrays are memory-mapped with
+    mmap_mode ('c' copy-on-write, so training can go on, 'r' read-only,
+    None reads them into memory). Derived values are recomputed.
+    """
+    with open(fname, 'rb') as f:
+        magic, version, n = struct.unpack('<4sII', f.read(12))
+        if magic != model_magic:
+            raise ValueError("%s is not a saved model" % fname)
+        if version != model_version:
+            raise ValueError("model format version %d, expected %d"
+                % (version, model_version))
+        header = json.loads(f.read(n))
+    start = _align(12 + n)
+    if mmap_mode is None:
+        data = np.fromfile(fname, np.uint8)
+    else:
+        data = np.memmap(fname, np.uint8, mmap_mode)
+    arrays = []
+    for spec in header['arrays']:
+        dtype = np.dtype(str(spec['dtype']))
+        shape = tuple(spec['shape'])
+        offset = start + spec['offset']
+        size = dtype.itemsize * int(np.prod(shape))
+        arrays.append(data[offset:offset + size].view(dtype).reshape(shape))
+    return _decode(header['root'], arrays, {})
+
+## the classes save_model can write
+saved_classes = dict((c.__name__, c) for c in [StandardGaussianMixture,
+    FullFactorSpheGaussianMixture, StickBreakingWeight, DPMixture,
+    SubDPMixture, DecaySheduler, ConstSheduler, NonBayesianWeight,
+    DirichletWeight])
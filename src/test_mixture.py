@@ -0,0 +1,261 @@
+import os
+import tempfile
+import numpy as np
+import unittest
+import model as md
+
+def sq_dist(X, mu):
+    return np.sum(np.square(X[:, np.newaxis, :] - mu[np.newaxis, :, :]), axis=2)
+
+def brute_standard(m, X):
+    return -0.5 * m.lmbd * sq_dist(X, m.mu) - 0.5 * m.dim / m.gamma\
+        - 0.5 * m.dim * np.log(2 * np.pi / m.lmbd)
+
+def brute_sphe(m, X):
+    # E[lambda |x - mu|^2] = E[lambda] |x - nu|^2 + dim / gamma
+    return -0.5 * m.expc_lambda * sq_dist(X, m.nu) - 0.5 * m.dim / m.gamma\
+        + 0.5 * m.dim * m.expc_lnlambda[np.newaxis, :]\
+        - 0.5 * m.dim * np.log(2 * np.pi)
+
+class TestLogLikelihood(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.random.randn(300, 4)
+
+    def test_standard(self):
+        m = md.StandardGaussianMixture(10, 4, 1.0, 2.0, self.X, md.ConstSheduler(0.5))
+        m.update(self.X[:50], 6, np.random.dirichlet(np.ones(10), 50))
+        self.assertTrue(np.allclose(m.log_likelihood(self.X), brute_standard(m, self.X)))
+
+    def test_sphe(self):
+        m = md.FullFactorSpheGaussianMixture(10, 4, 1.0, 2.0, 1.0, self.X, md.ConstSheduler(0.5))
+        m.update(self.X[:50], 6, np.random.dirichlet(np.ones(10), 50))
+        self.assertTrue(np.allclose(m.log_likelihood(self.X), brute_sphe(m, self.X)))
+
+    def test_translation(self):
+        # only x - mu matters, moving the data and the means together
+        # changes nothing
+        shift = 5 * np.random.randn(4)
+        m = md.StandardGaussianMixture(10, 4, 1.0, 2.0, self.X, md.ConstSheduler(0.5))
+        logl = m.log_likelihood(self.X)
+        m.mu = m.mu + shift
+        m._updateCache()
+        self.assertTrue(np.allclose(m.log_likelihood(self.X + shift), logl))
+        m = md.FullFactorSpheGaussianMixture(10, 4, 1.0, 2.0, 1.0, self.X, md.ConstSheduler(0.5))
+        logl = m.log_likelihood(self.X)
+        m.nu = m.nu + shift
+        m._updateExpectation()
+        self.assertTrue(np.allclose(m.log_likelihood(self.X + shift), logl))
+
+    def test_out(self):
+        base = md.FullFactorSpheGaussianMixture(10, 4, 1.0, 2.0, 1.0, self.X, md.ConstSheduler(0.5))
+        dp = md.DPMixture(10, 4, base, md.StickBreakingWeight(10, 1.0), md.ConstSheduler(0.5))
+        out = np.empty((300, 10))
+        z = dp.assign(self.X, out)
+        self.assertTrue(z is out)
+        self.assertTrue(np.allclose(z.sum(1), 1.0))
+        self.assertTrue(np.array_equal(dp.predict(self.X), z.argmax(1)))
+        dp.update(self.X, 1.0, out=out)
+
+class TestUpdateGroups(unittest.TestCase):
+    def make(self, G):
+        np.random.seed(0)
+        X = np.random.randn(400, 3)
+        base = md.FullFactorSpheGaussianMixture(8, 3, 1.0, 2.0, 1.0, X, md.ConstSheduler(0.5))
+        base = md.DPMixture(8, 3, base, md.StickBreakingWeight(8, 1.0), md.ConstSheduler(0.5))
+        models = [md.SubDPMixture(4, 1.0, base, md.ConstSheduler(0.5)) for g in range(G)]
+        return X, base, models
+
+    def test_single_group(self):
+        # one group is exactly SubDPMixture.update
+        X, base, models = self.make(1)
+        X2, base2, models2 = self.make(1)
+        md.update_groups(models, [X[:50]], [8.0], base_scale=8.0)
+        models2[0].update(X2[:50], 8.0)
+        self.assertTrue(np.allclose(models[0].phi, models2[0].phi))
+        self.assertTrue(np.allclose(base.model.nu, base2.model.nu))
+
+    def test_round(self):
+        X, base, models = self.make(3)
+        batches = [X[i*50:(i+1)*50] for i in range(3)]
+        for i in range(3):
+            md.update_groups(models, batches, [8.0] * 3)
+        self.assertTrue(np.all(np.isfinite(base.model.nu)))
+        self.assertTrue(np.allclose(models[1].phi.sum(1), 1.0))
+        self.assertRaises(ValueError, md.update_groups, models, batches[:2], [8.0] * 3)
+
+class TestTrainer(unittest.TestCase):
+    def make(self):
+        np.random.seed(0)
+        centers = 10 * np.random.randn(4, 2)
+        X = centers[np.random.randint(4, size=2000)] + np.random.randn(2000, 2)
+        base = md.FullFactorSpheGaussianMixture(8, 2, 1.0, 2.0, 1.0, X, md.ConstSheduler(0.5))
+        model = md.DPMixture(8, 2, base, md.StickBreakingWeight(8, 1.0), md.ConstSheduler(0.5))
+        return X, model
+
+    def test_fit(self):
+        X, model = self.make()
+        loglik = md.Trainer(model, md.DecaySheduler(1, 0.6, 0.01)).fit(X, 3, 10)
+        self.assertEqual(len(loglik), 3)
+        self.assertTrue(isinstance(model.lrshdl, md.DecaySheduler))
+
+    def test_early_stop(self):
+        X, model = self.make()
+        monitor = md.ConvergenceMonitor(size=200, tol=1e-3, patience=2)
+        loglik = md.Trainer(model).fit(X, 100, 10, monitor)
+        self.assertTrue(len(loglik) < 100)
+        self.assertEqual(loglik, monitor.history)
+        self.assertEqual(monitor.sample.shape, (200, 2))
+
+    def test_reservoir(self):
+        X, model = self.make()
+        monitor = md.ConvergenceMonitor(size=100, reservoir=True)
+        monitor.start(X)
+        monitor.observe(X[:60])
+        self.assertTrue(np.array_equal(monitor.sample[:60], X[:60]))
+        monitor.observe(X[60:1000])
+        self.assertEqual(monitor.seen, 1000)
+        # every kept row is a row of the stream
+        rows = set(map(tuple, X[:1000]))
+        self.assertTrue(all(tuple(r) in rows for r in monitor.sample))
+        self.assertTrue(np.isfinite(monitor.score(model, 2000)))
+
+class TestPrefetch(unittest.TestCase):
+    def test_order(self):
+        X = np.random.randn(100, 3)
+        batches = [X[i:i + 7] for i in range(0, 100, 7)]
+        out = list(md.prefetch_batches(iter(batches), 2))
+        self.assertEqual(len(out), len(batches))
+        self.assertTrue(all(np.array_equal(a, b) for a, b in zip(out, batches)))
+
+    def test_error(self):
+        def source():
+            yield np.zeros((2, 2))
+            raise KeyError('broken source')
+        it = md.prefetch_batches(source())
+        self.assertEqual(next(it).shape, (2, 2))
+        self.assertRaises(KeyError, next, it)
+
+    def test_early_close(self):
+        it = md.prefetch_batches(np.zeros((3, 2)) for i in range(1000))
+        next(it)
+        it.close()
+
+    def test_fit(self):
+        # the same minibatches, so the same model with or without prefetching
+        X, model = TestTrainer('test_fit').make()
+        X2, model2 = TestTrainer('test_fit').make()
+        np.random.seed(1)
+        loglik = md.Trainer(model).fit(X, 2, 10)
+        np.random.seed(1)
+        loglik2 = md.Trainer(model2).fit(X2, 2, 10, prefetch=2)
+        self.assertTrue(np.allclose(loglik, loglik2))
+        self.assertTrue(np.allclose(model.model.nu, model2.model.nu))
+
+class TestSaveLoad(unittest.TestCase):
+    def setUp(self):
+        np.random.seed(0)
+        self.X = np.random.randn(300, 3)
+        self.fname = tempfile.mktemp()
+
+    def tearDown(self):
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+    def make_base(self):
+        base = md.FullFactorSpheGaussianMixture(8, 3, 1.0, 2.0, 1.0, self.X, md.ConstSheduler(0.5))
+        base = md.DPMixture(8, 3, base, md.StickBreakingWeight(8, 1.0), md.DecaySheduler(1, 0.6, 0.01))
+        base.update(self.X[:100], 3.0)
+        return base
+
+    def test_dpmixture(self):
+        base = self.make_base()
+        md.save_model(base, self.fname)
+        for mode in ('c', 'r', None):
+            loaded = md.load_model(self.fname, mode)
+            self.assertTrue(np.array_equal(loaded.log_likelihood(self.X), base.log_likelihood(self.X)))
+            self.assertEqual(loaded.lrshdl.count, base.lrshdl.count)
+        self.assertTrue(isinstance(loaded.model.nu, np.ndarray))
+        # copy-on-write maps can go on training
+        loaded = md.load_model(self.fname)
+        self.assertTrue(isinstance(loaded.model.nu, np.memmap))
+        loaded.update(self.X[100:200], 3.0)
+        base.update(self.X[100:200], 3.0)
+        self.assertTrue(np.allclose(loaded.model.nu, base.model.nu))
+        self.assertTrue(np.array_equal(md.load_model(self.fname).weight.sticks,
+            md.load_model(self.fname, None).weight.sticks))
+
+    def test_shared_base(self):
+        base = self.make_base()
+        models = [md.SubDPMixture(4, 1.0, base, md.ConstSheduler(0.5)) for g in range(2)]
+        md.save_model(models, self.fname)
+        loaded = md.load_model(self.fname)
+        self.assertTrue(loaded[0].base is loaded[1].base)
+        self.assertTrue(np.array_equal(loaded[1].predict(self.X), models[1].predict(self.X)))
+
+    def test_errors(self):
+        self.assertRaises(TypeError, md.save_model, object(), self.fname)
+        with open(self.fname, 'wb') as f:
+            f.write('not a model at all')
+        self.assertRaises(ValueError, md.load_model, self.fname)
+
+class TestGrowth(unittest.TestCase):
+    def test_weight_resize(self):
+        w = md.StickBreakingWeight(5, 1.0)
+        w.update(np.random.dirichlet(np.ones(5), 30), 10.0, 0.5)
+        sticks = w.sticks.copy()
+        w.setCounts(w.counts())
+        self.assertTrue(np.allclose(w.sticks, sticks))
+        logw = w.logWeight().copy()
+        w.grow(2)
+        self.assertEqual(w.sticks.shape, (2, 6))
+        w.keep([0, 1, 2, 3, 4])
+        self.assertTrue(np.allclose(w.logWeight(), logw))
+
+    def test_births(self):
+        np.random.seed(0)
+        centers = 10 * np.random.randn(6, 3)
+        X = centers[np.random.randint(6, size=5000)] + np.random.randn(5000, 3)
+        base = md.FullFactorSpheGaussianMixture(2, 3, 1.0, 2.0, 2.0, X, md.ConstSheduler(0.5))
+        dp = md.DPMixture(2, 3, base, md.StickBreakingWeight(2, 1.0), md.DecaySheduler(1, 0.6, 0.001))
+        dp.setGrowth(30, births=2)
+        for i in range(100):
+            dp.update(X[np.random.randint(5000, size=200)], 25.0)
+        self.assertTrue(4 <= dp.K < 30)
+        self.assertEqual(dp.K, base.K)
+        self.assertEqual(base.nu.shape, (dp.K, 3))
+        self.assertEqual(dp.weight.sticks.shape, (2, dp.K - 1))
+        self.assertEqual(dp.log_likelihood(X).shape, (5000, dp.K))
+
+    def test_births_tiny_gamma0(self):
+        # the gamma0 of cluster_doc.py, a newborn at the prior would have
+        # a mean uncertainty of dim / 1e-10 and never win its point
+        np.random.seed(0)
+        centers = 10 * np.random.randn(8, 5)
+        X = centers[np.random.randint(8, size=20000)] + np.random.randn(20000, 5)
+        base = md.FullFactorSpheGaussianMixture(2, 5, 1e-10, 2.0, 2.0, X, md.ConstSheduler(0.5))
+        dp = md.DPMixture(2, 5, base, md.StickBreakingWeight(2, 1.0), md.DecaySheduler(1, 0.6, 0.001))
+        dp.setGrowth(50, births=3)
+        ks = []
+        for i in range(100):
+            dp.update(X[np.random.randint(20000, size=200)], 25.0)
+            ks.append(dp.K)
+        self.assertTrue(max(ks[1:]) > ks[0])
+        self.assertTrue(6 <= dp.K < 50)
+
+    def test_shared_base(self):
+        # sub-mixtures hold phi over the base components, so a base
+        # trained through them keeps its K
+        X, base, models = TestUpdateGroups('test_round').make(3)
+        base.setGrowth(20, retire=0.05)
+        K = base.K
+        for i in range(10):
+            batches = [X[np.random.randint(400, size=50)] for m in models]
+            md.update_groups(models, batches, [8.0] * 3)
+            models[0].update(batches[0], 8.0)
+        self.assertEqual(base.K, K)
+        self.assertEqual(models[2].phi.shape, (4, K))
+        self.assertEqual(models[1].predict(X).shape, (400,))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,646 @@
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.special as sp
+import onlinedpgmm
+
+modes = ['full', 'diagonal', 'spherical', 'semi-spherical']
+
+def new_dp(mode, T=6, dim=3):
+    dp = onlinedpgmm.OnlineDP(T, 1.0, 0.6, 1, 1000, dim, mode)
+    return dp
+
+class TestDiffSquare(unittest.TestCase):
+    def test_diff_square(self):
+        X = np.random.randn(50, 3)
+        for mode in modes:
+            dp = new_dp(mode)
+            ds = dp.diff_square(X)
+            for t in range(dp.m_T):
+                dx = X - dp.m_mean[t]
+                if mode == 'full':
+                    d = np.sum(np.dot(dx, dp.m_precis[t]) * dx, 1)
+                elif mode == 'diagonal':
+                    d = np.sum(dx * dx * dp.m_precis[t], 1)
+                else:
+                    d = np.sum(dx * dx, 1) * dp.m_precis[t]
+                self.assertTrue(np.allclose(ds[:, t], d))
+
+class TestFullCov(unittest.TestCase):
+    def test_cached_factors(self):
+        dp = new_dp('full')
+        dp.process_documents([np.random.randn(100, 3)])
+        dp.update_par(dp.var_x2, dp.var_x1, dp.var_x0)
+        cov = dp.get_cov()
+        for t in range(dp.m_T):
+            self.assertTrue(np.allclose(np.dot(cov[t], dp.m_precis[t]), np.eye(3)))
+            x0 = dp.var_x0[t]
+            const = 0.5 * (np.log(np.linalg.det(dp.m_precis[t])) \
+                + np.sum(sp.psi(0.5 * (x0 - np.arange(3))))) \
+                - 1.5 * (np.log(x0 * 0.5) + 1.0 / x0 + np.log(2 * np.pi))
+            self.assertTrue(np.allclose(dp.m_const[t], const))
+
+class TestSuffStats(unittest.TestCase):
+    def test_add_to_sstats(self):
+        X = np.random.randn(40, 3)
+        z = np.random.dirichlet(np.ones(6), 40)
+        for mode in modes:
+            dp = new_dp(mode)
+            ss = onlinedpgmm.SuffStats(6, 3, mode)
+            buf = {}
+            dp.add_to_sstats(z, z, X, ss, buf)
+            dp.add_to_sstats(z, z, X, ss, buf)
+            xz = X[:, np.newaxis, :] * z[:, :, np.newaxis]
+            self.assertTrue(np.allclose(ss.var_x1, 2 * np.sum(xz, 0)))
+            if mode == 'full':
+                x2 = np.einsum('nt,ni,nj->tij', z, X, X)
+            elif mode == 'diagonal':
+                x2 = np.sum(xz * X[:, np.newaxis, :], 0)
+            elif mode == 'spherical':
+                x2 = np.dot(np.sum(X * X, 1), z)
+            else:
+                const = 3 / (dp.var_x0[:, 0] * dp.m_precis)
+                dx = X[:, np.newaxis, :] - dp.m_mean[np.newaxis]
+                x2 = np.sum((np.sum(dx * dx, 2) + const) * z, 0)
+            self.assertTrue(np.allclose(ss.var_x2, 2 * x2))
+
+class TestSuffStatsApi(unittest.TestCase):
+    def filled(self, mode, ss=None):
+        if ss is None:
+            ss = onlinedpgmm.SuffStats(6, 3, mode)
+        X = np.random.randn(20, 3)
+        z = np.random.dirichlet(np.ones(6), 20)
+        new_dp(mode).add_to_sstats(z, z, X, ss)
+        return ss
+
+    def test_merge_scale_reset(self):
+        for mode in modes:
+            a, b = self.filled(mode), self.filled(mode)
+            c = a + b
+            self.assertTrue(np.allclose(c.var_x2, a.var_x2 + b.var_x2))
+            self.assertAlmostEqual(c.batchsize, a.batchsize + b.batchsize)
+            c.scale(0.5)
+            self.assertTrue(np.allclose(c.var_x1, 0.5 * (a.var_x1 + b.var_x1)))
+            c.reset()
+            self.assertEqual(c.batchsize, 0)
+            self.assertFalse(np.any(c.var_x2))
+
+    def test_encoding(self):
+        for mode in modes:
+            a = self.filled(mode)
+            b = onlinedpgmm.SuffStats.fromstring(a.tostring())
+            self.assertEqual(b.mode, mode)
+            self.assertTrue(np.array_equal(a.m_data, b.m_data))
+            c = pickle.loads(pickle.dumps(a, 2))
+            self.assertTrue(np.array_equal(a.var_x2, c.var_x2))
+
+    def test_backing(self):
+        ss = self.filled('full', onlinedpgmm.SuffStats.shared(6, 3, 'full'))
+        self.assertTrue(ss.batchsize > 0)
+        fname = tempfile.mktemp()
+        try:
+            ss = self.filled('diagonal', onlinedpgmm.SuffStats.memmap(fname, 6, 3, 'diagonal'))
+            ss.m_data.flush()
+            back = onlinedpgmm.SuffStats.memmap(fname, 6, 3, 'diagonal', create=False)
+            self.assertTrue(np.array_equal(back.var_x2, ss.var_x2))
+        finally:
+            os.remove(fname)
+
+class TestSparse(unittest.TestCase):
+    def test_top_k(self):
+        z = np.random.dirichlet(np.ones(6) * 0.3, 40)
+        s = onlinedpgmm.sparse_top_k(z, 2)
+        self.assertTrue(np.all(np.diff(s.indptr) == 2))
+        self.assertTrue(np.allclose(np.asarray(s.sum(1)).ravel(), 1.0))
+        self.assertTrue(np.array_equal(np.asarray(s.argmax(1)).ravel(), z.argmax(1)))
+        s = onlinedpgmm.sparse_top_k(z, threshold=0.9)
+        self.assertTrue(np.all(np.diff(s.indptr) >= 1))
+
+    def test_buffers(self):
+        z = np.random.dirichlet(np.ones(6) * 0.3, 40)
+        buf = {}
+        s = onlinedpgmm.sparse_top_k(z, 3, 0.05, buf)
+        keep = buf['keep']
+        s2 = onlinedpgmm.sparse_top_k(z, 3, 0.05, buf)
+        self.assertTrue(buf['keep'] is keep)
+        self.assertTrue(np.array_equal(s.toarray(), s2.toarray()))
+        self.assertTrue(np.array_equal(s.toarray(),
+            onlinedpgmm.sparse_top_k(z, 3, 0.05).toarray()))
+        # the kept entries are the three largest ones >= 0.05 or the largest
+        nnz = np.minimum(3, np.maximum(1, np.sum(z >= 0.05, 1)))
+        self.assertTrue(np.array_equal(np.diff(s.indptr), nnz))
+
+    def test_add_to_sstats(self):
+        X = np.random.randn(40, 3)
+        z = np.random.dirichlet(np.ones(6), 40)
+        for mode in modes:
+            dp = new_dp(mode)
+            dense = onlinedpgmm.SuffStats(6, 3, mode)
+            dp.add_to_sstats(z, z, X, dense)
+            # keeping every entry gives the dense statistics
+            s = onlinedpgmm.sparse_top_k(z, 6)
+            ss = onlinedpgmm.SuffStats(6, 3, mode)
+            dp.add_to_sstats(s, s, X, ss)
+            self.assertTrue(np.allclose(ss.m_data, dense.m_data))
+            dp.set_sparse(2)
+            ss.reset()
+            s = dp.sparsify(z)
+            dp.add_to_sstats(s, s, X, ss)
+            self.assertAlmostEqual(ss.batchsize, 40)
+            self.assertTrue(np.allclose(ss.var_x1, s.T.dot(X)))
+
+    def test_hdp(self):
+        np.random.seed(0)
+        X = np.random.randn(100, 3)
+        for batched in (False, True):
+            hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 100, 3, 'diagonal')
+            hdp.set_sparse(k=2)
+            groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 20,
+                onlinedpgmm.ListData(X[i*50:(i+1)*50])) for i in range(2)]
+            hdp.process_groups(groups, batched=batched)
+            self.assertTrue(np.all(np.isfinite(hdp.m_mean)))
+
+class TestChunkedEStep(unittest.TestCase):
+    def run_model(self, cls, mode, chunk):
+        np.random.seed(0)
+        X = np.random.randn(300, 3)
+        if cls is onlinedpgmm.OnlineDP:
+            model = new_dp(mode)
+        else:
+            model = cls(6, 4, 1.0, 1.0, 0.6, 1, 1000, 3, mode)
+        for i in range(2):
+            score = model.process_documents([X, X[:50]], chunk=chunk)
+        return model, score
+
+    def test_chunked(self):
+        for cls in (onlinedpgmm.OnlineDP, onlinedpgmm.OnlineHDP):
+            for mode in modes:
+                whole, score = self.run_model(cls, mode, None)
+                chunked, chunked_score = self.run_model(cls, mode, 64)
+                self.assertTrue(np.allclose(whole.m_mean, chunked.m_mean))
+                self.assertTrue(np.allclose(whole.var_stick, chunked.var_stick))
+                self.assertTrue(np.isclose(score, chunked_score))
+
+class TestCompaction(unittest.TestCase):
+    def test_compact(self):
+        np.random.seed(0)
+        X = np.random.randn(200, 3) * 0.1 + np.repeat(np.eye(3) * 5, [70, 70, 60], 0)
+        for mode in modes:
+            hdp = onlinedpgmm.OnlineHDP(20, 4, 1.0, 1.0, 0.6, 1, 200, 3, mode)
+            hdp.init_par(init_mean=X.copy(), init_cov=0.1,
+                prior_x0=(1, 10) if mode == 'semi-spherical' else None)
+            groups = [onlinedpgmm.Group(1.0, 4, 20, 100, 50,
+                onlinedpgmm.ListData(X[i*100:(i+1)*100])) for i in range(2)]
+            hdp.set_compaction(2, 1.0)
+            for i in range(6):
+                hdp.process_groups(groups)
+            T = hdp.m_T
+            self.assertTrue(T < 20)
+            self.assertEqual(hdp.m_mean.shape[0], T)
+            self.assertEqual(hdp.var_stick.shape, (2, T - 1))
+            self.assertEqual(hdp.E_log_gauss(X).shape, (200, T))
+            self.assertEqual(groups[0].m_varphi.shape, (4, T))
+            late = onlinedpgmm.Group(1.0, 4, 20, 100, 50, groups[0].data)
+            self.assertEqual(hdp.predict(X, late).shape, (200,))
+            self.assertEqual(late.m_varphi.shape, (4, T))
+
+class TestFloat32(unittest.TestCase):
+    def test_e_step_dtype(self):
+        X = np.random.randn(100, 3)
+        for mode in modes:
+            np.random.seed(0)
+            dp64 = new_dp(mode)
+            np.random.seed(0)
+            dp32 = onlinedpgmm.OnlineDP(6, 1.0, 0.6, 1, 1000, 3, mode, np.float32)
+            elg = dp32.E_log_gauss(X)
+            self.assertEqual(elg.dtype, np.float32)
+            self.assertTrue(np.allclose(elg, dp64.E_log_gauss(X), rtol=1e-4, atol=1e-3))
+            v, _ = onlinedpgmm.log_normalize(elg)
+            self.assertEqual(v.dtype, np.float32)
+
+    def test_hdp(self):
+        X = np.random.randn(100, 3)
+        for mode in modes:
+            hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 100, 3, mode, np.float32)
+            groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 20,
+                onlinedpgmm.ListData(X[i*50:(i+1)*50])) for i in range(2)]
+            for i in range(3):
+                hdp.process_groups(groups)
+                hdp.process_groups(groups, fast=False)
+            self.assertEqual(hdp.var_stick.dtype, np.float64)
+            self.assertEqual(hdp.var_x1.dtype, np.float64)
+            self.assertEqual(groups[0].m_varphi.dtype, np.float64)
+            self.assertTrue(np.all(np.isfinite(hdp.m_mean)))
+
+class TestWorkspace(unittest.TestCase):
+    def test_log_normalize_into(self):
+        for dtype in (np.float64, np.float32):
+            for v in (np.random.randn(20, 6), np.random.randn(6)):
+                v = 10 * v.astype(dtype)
+                log_v, log_norm = onlinedpgmm.log_normalize(v)
+                out_log, out = np.empty_like(v), v.copy()
+                norm = onlinedpgmm.log_normalize_into(out, out_log, out)
+                self.assertTrue(np.array_equal(out_log, log_v))
+                self.assertTrue(np.array_equal(out, np.exp(log_v)))
+                self.assertTrue(np.array_equal(norm, log_norm))
+
+    def test_reuse(self):
+        X = np.random.randn(100, 3)
+        hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 100, 3, 'diagonal')
+        groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 20,
+            onlinedpgmm.ListData(X[i*50:(i+1)*50]), online=False) for i in range(2)]
+        hdp.process_groups(groups, fast=False)
+        phi = hdp.m_work['phi']
+        varphi = groups[0].m_varphi.copy()
+        hdp.process_groups(groups, fast=False)
+        self.assertTrue(hdp.m_work['phi'] is phi)
+        # the group state does not alias the workspace
+        self.assertFalse(np.shares_memory(groups[0].m_varphi, hdp.m_work['varphi']))
+        self.assertFalse(np.array_equal(groups[0].m_varphi, varphi))
+
+    def test_sstats_buffers(self):
+        # the statistics scratch of training lives in the workspace, one
+        # set per thread when threaded
+        X = np.random.randn(100, 3)
+        dp = new_dp('full')
+        dp.process_documents([X])
+        x1 = dp.m_work['x1']
+        dp.process_documents([X])
+        self.assertTrue(dp.m_work['x1'] is x1)
+        dp.start_threads(2)
+        dp.process_documents([X])
+        self.assertTrue(any('zX' in w for w in dp.m_work.values()
+            if isinstance(w, dict)))
+        dp.stop_threads()
+        self.assertFalse(any(isinstance(w, dict) for w in dp.m_work.values()))
+
+class TestStepPolicy(unittest.TestCase):
+    def run_dp(self, step):
+        np.random.seed(0)
+        X = np.random.randn(400, 3)
+        dp = new_dp('diagonal')
+        dp.set_step(step)
+        for i in range(20):
+            dp.process_documents([X[i*20:(i+1)*20]])
+        return dp
+
+    def test_decay(self):
+        # the default schedule
+        dp1 = self.run_dp(None)
+        dp2 = self.run_dp(onlinedpgmm.DecayStep(1, 0.6, onlinedpgmm.rhot_bound))
+        self.assertTrue(np.allclose(dp1.m_mean, dp2.m_mean))
+        self.assertEqual(self.run_dp(onlinedpgmm.ConstStep(0.3)).m_rhot, 0.3)
+
+    def test_adaptive(self):
+        step = onlinedpgmm.AdaptiveStep(onlinedpgmm.DecayStep(1, 0.6), tau0=5)
+        dp = self.run_dp(step)
+        self.assertTrue(0 < dp.m_rhot <= 1)
+        self.assertTrue(step.m_tau >= 1)
+        self.assertTrue(np.all(np.isfinite(dp.m_mean)))
+
+    def test_groups(self):
+        np.random.seed(0)
+        X = np.random.randn(100, 3)
+        hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 100, 3, 'diagonal')
+        hdp.set_step(onlinedpgmm.AdaptiveStep(onlinedpgmm.DecayStep(1, 0.6), 2))
+        groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 20,
+            onlinedpgmm.ListData(X[i*50:(i+1)*50]),
+            step=onlinedpgmm.AdaptiveStep(onlinedpgmm.DecayStep(1, 0.6), 2))
+            for i in range(2)]
+        for i in range(4):
+            hdp.process_groups(groups)
+            hdp.process_groups(groups, fast=False)
+            hdp.process_groups(groups, batched=True)
+        self.assertTrue(groups[0].step.m_tau > 2)
+        path = tempfile.mkdtemp()
+        try:
+            hdp.save_checkpoint(os.path.join(path, 'ckpt'), groups)
+            model, restored = onlinedpgmm.load_checkpoint(os.path.join(path, 'ckpt'))
+            self.assertTrue(isinstance(model.m_step, onlinedpgmm.AdaptiveStep))
+            self.assertTrue(isinstance(model.m_step.m_warmup, onlinedpgmm.DecayStep))
+            self.assertTrue(np.array_equal(restored[1].step.m_gbar, groups[1].step.m_gbar))
+        finally:
+            shutil.rmtree(path)
+
+class TestThreads(unittest.TestCase):
+    def test_doc_e_step(self):
+        np.random.seed(0)
+        X = np.random.randn(300, 3)
+        for cls in (onlinedpgmm.OnlineDP, onlinedpgmm.OnlineHDP):
+            for mode in modes:
+                models = []
+                for threads in (None, 3):
+                    np.random.seed(0)
+                    if cls is onlinedpgmm.OnlineDP:
+                        model = new_dp(mode)
+                    else:
+                        model = cls(6, 4, 1.0, 1.0, 0.6, 1, 1000, 3, mode)
+                    if threads:
+                        model.start_threads(threads)
+                    for i in range(2):
+                        model.process_documents([X, X[:50]])
+                    model.stop_threads()
+                    models.append(model)
+                self.assertTrue(np.allclose(models[0].m_mean, models[1].m_mean))
+                self.assertTrue(np.allclose(models[0].var_stick, models[1].var_stick))
+
+    def test_chunked(self):
+        # many slices over few threads, the same statistics on every run
+        np.random.seed(0)
+        X = np.random.randn(300, 3)
+        for cls in (onlinedpgmm.OnlineDP, onlinedpgmm.OnlineHDP):
+            results = []
+            for threads in (None, 3, 3):
+                np.random.seed(1)
+                model = cls(6, 4, 1.0, 1.0, 0.6, 1, 1000, 3, 'full') \
+                    if cls is onlinedpgmm.OnlineHDP else new_dp('full')
+                ss = onlinedpgmm.SuffStats(6, 3, 'full')
+                if threads:
+                    model.start_threads(threads)
+                model.doc_e_step(X, ss, onlinedpgmm.expect_log_sticks(model.var_stick),
+                    1e-6, chunk=20)
+                model.stop_threads()
+                results.append(ss)
+            self.assertTrue(np.allclose(results[0].var_x2, results[1].var_x2))
+            self.assertTrue(np.array_equal(results[1].var_x2, results[2].var_x2))
+            self.assertTrue(np.array_equal(results[1].var_stick, results[2].var_stick))
+
+    def test_checkpoint(self):
+        dp = new_dp('diagonal')
+        dp.start_threads(2)
+        dp.process_documents([np.random.randn(100, 3)])
+        path = tempfile.mkdtemp()
+        try:
+            dp.save_checkpoint(os.path.join(path, 'ckpt'))
+            model, groups = onlinedpgmm.load_checkpoint(os.path.join(path, 'ckpt'))
+            self.assertTrue(model.m_threads is None)
+        finally:
+            dp.stop_threads()
+            shutil.rmtree(path)
+
+class BrokenData:
+    def __init__(self, good):
+        self.good = good
+    def size(self):
+        return 100
+    def sample(self, n):
+        if self.good == 0:
+            raise IOError('broken source')
+        self.good -= 1
+        return np.zeros((n, 3))
+    def reset(self):
+        self.good = 1
+
+class TestPrefetch(unittest.TestCase):
+    def test_sample(self):
+        X = np.random.randn(100, 3)
+        data = onlinedpgmm.PrefetchData(onlinedpgmm.ListData(X), 20, 3, 'float32')
+        try:
+            rows = set(map(tuple, X.astype('float32')))
+            for i in range(10):
+                batch = data.sample(20)
+                self.assertEqual(batch.shape, (20, 3))
+                self.assertEqual(batch.dtype, np.float32)
+                self.assertTrue(batch.flags['C_CONTIGUOUS'])
+                self.assertTrue(all(tuple(r) in rows for r in batch))
+            self.assertEqual(data.size(), 100)
+            self.assertRaises(ValueError, data.sample, 10)
+        finally:
+            data.close()
+
+    def test_error(self):
+        data = onlinedpgmm.PrefetchData(BrokenData(1), 5)
+        try:
+            self.assertEqual(data.sample(5).shape, (5, 3))
+            self.assertRaises(IOError, data.sample, 5)
+            self.assertRaises(IOError, data.sample, 5)
+            data.reset()
+            self.assertEqual(data.sample(5).shape, (5, 3))
+        finally:
+            data.close()
+
+    def test_next_n_record(self):
+        # the hdpcluster.py pass over a group's data after training
+        path = tempfile.mkdtemp()
+        try:
+            X = np.random.randn(60, 3)
+            with open(os.path.join(path, 'data.txt'), 'w') as f:
+                for i, x in enumerate(X):
+                    f.write('t%d %r %r %r\n' % ((i,) + tuple(x)))
+            onlinedpgmm.convert_text_data(os.path.join(path, 'data.txt'),
+                os.path.join(path, 'data.npy'),
+                lambda line: [float(r) for r in line.split()[1:]])
+            hdp = onlinedpgmm.OnlineHDP(8, 4, 1.0, 1.0, 0.6, 1, 60, 3, 'diagonal')
+            group = onlinedpgmm.Group(1.0, 4, 8, 60, 20,
+                onlinedpgmm.MmapData(os.path.join(path, 'data.npy')), prefetch=2)
+            for i in range(3):
+                hdp.process_groups([group])
+            group.data.reset()
+            labels, Y = group.data.next_n_record(1000)
+            self.assertEqual(labels, ['t%d' % i for i in range(60)])
+            self.assertTrue(np.array_equal(Y, X))
+            self.assertEqual(group.data.size(), 60)
+            self.assertEqual(group.sample().shape, (20, 3))
+            group.data.close()
+        finally:
+            shutil.rmtree(path)
+
+    def test_fit(self):
+        # the same minibatches with or without prefetching
+        X = np.random.randn(500, 3)
+        dps = []
+        for prefetch in (0, 2):
+            np.random.seed(0)
+            dp = new_dp('diagonal')
+            dp.fit(X, 50, 5, prefetch)
+            dps.append(dp)
+        self.assertTrue(np.allclose(dps[0].m_mean, dps[1].m_mean))
+
+    def test_group(self):
+        X = np.random.randn(200, 3)
+        hdp = onlinedpgmm.OnlineHDP(8, 4, 1.0, 1.0, 0.6, 1, 200, 3, 'diagonal')
+        groups = [onlinedpgmm.Group(1.0, 4, 8, 100, 20,
+            onlinedpgmm.ListData(X[i*100:(i+1)*100]), prefetch=2) for i in range(2)]
+        try:
+            for i in range(3):
+                hdp.process_groups(groups)
+            self.assertTrue(np.all(np.isfinite(hdp.m_mean)))
+        finally:
+            for group in groups:
+                group.data.close()
+
+class TestCheckpoint(unittest.TestCase):
+    def test_resume(self):
+        X = np.random.randn(200, 3)
+        path = tempfile.mkdtemp()
+        try:
+            for mode in modes:
+                hdp = onlinedpgmm.OnlineHDP(8, 4, 1.0, 1.0, 0.6, 1, 200, 3, mode)
+                groups = [onlinedpgmm.Group(1.0, 4, 8, 100, 20,
+                    onlinedpgmm.ListData(X[i*100:(i+1)*100])) for i in range(2)]
+                hdp.set_compaction(2, 1e-3)
+                for i in range(4):
+                    hdp.process_groups(groups)
+                hdp.save_checkpoint(path + '/ckpt', groups)
+                hdp.save_checkpoint(path + '/ckpt', groups)
+                hdp2, groups2 = onlinedpgmm.load_checkpoint(path + '/ckpt',
+                    [onlinedpgmm.Group(1.0, 4, 8, 100, 20, g.data) for g in groups])
+                self.assertEqual(hdp2.m_updatect, hdp.m_updatect)
+                self.assertEqual(hdp2.m_dtype, hdp.m_dtype)
+                self.assertEqual(groups2[1].update_timect, groups[1].update_timect)
+                for g, g2 in zip(groups, groups2):
+                    self.assertTrue(np.array_equal(g.m_varphi, g2.m_varphi))
+                np.random.seed(3)
+                hdp.process_groups(groups)
+                np.random.seed(3)
+                hdp2.process_groups(groups2)
+                self.assertTrue(np.allclose(hdp.m_mean, hdp2.m_mean))
+                self.assertTrue(np.allclose(hdp.var_x2, hdp2.var_x2))
+                self.assertTrue(np.allclose(groups[0].m_v, groups2[0].m_v))
+        finally:
+            shutil.rmtree(path)
+
+class TestMmapData(unittest.TestCase):
+    def test_convert(self):
+        path = tempfile.mkdtemp()
+        try:
+            X = np.random.randn(7, 3)
+            with open(path + '/data.txt', 'w') as f:
+                for i, x in enumerate(X):
+                    f.write('t%d##title %d##%s\n' % (i % 2, i, ' '.join(map(repr, x))))
+            parser = lambda line: [float(a) for a in line.split('##')[2].split()]
+            n = onlinedpgmm.convert_text_data(path + '/data.txt', path + '/data.npy',
+                parser, lambda line: line.split('##')[0])
+            self.assertEqual(n, 7)
+            text = onlinedpgmm.FileData(path + '/data.txt', parser)
+            data = onlinedpgmm.MmapData(path + '/data.npy')
+            self.assertEqual(data.size(), text.size())
+            text.reset()
+            for i in range(4):
+                self.assertTrue(np.array_equal(data.sample(3), text.sample(3)))
+            data.reset()
+            labels, Y = data.next_n_record(5)
+            self.assertEqual(labels, ['t0', 't1', 't0', 't1', 't0'])
+            self.assertTrue(np.array_equal(Y, X[:5]))
+            labels, Y = data.next_n_record(5)
+            self.assertEqual(len(labels), 2)
+        finally:
+            shutil.rmtree(path)
+
+class TestElboPolicy(unittest.TestCase):
+    def run_hdp(self, policy, fast):
+        np.random.seed(0)
+        X = np.random.randn(100, 3)
+        hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 100, 3, 'spherical')
+        hdp.set_elbo_policy(policy)
+        groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 20,
+            onlinedpgmm.ListData(X[i*50:(i+1)*50])) for i in range(2)]
+        return [hdp.process_groups(groups, fast) for i in range(3)], hdp
+
+    def test_policy(self):
+        always, hdp1 = self.run_hdp('always', True)
+        final, hdp2 = self.run_hdp('final', True)
+        self.assertTrue(np.allclose(always, final))
+        self.assertTrue(np.allclose(hdp1.m_mean, hdp2.m_mean))
+        never, hdp3 = self.run_hdp('never', False)
+        self.assertEqual(never, [0.0] * 3)
+        every, hdp4 = self.run_hdp(2, False)
+        self.assertTrue(np.all(np.isfinite(every)))
+        self.assertRaises(ValueError, hdp4.set_elbo_policy, 'sometimes')
+
+class TestBatchedGroups(unittest.TestCase):
+    def run_hdp(self, batched, sizes):
+        np.random.seed(0)
+        X = np.random.randn(200, 3)
+        hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 200, 3, 'diagonal')
+        groups = [onlinedpgmm.Group(1.0, 4, 6, 50, size,
+            onlinedpgmm.ListData(X[i*50:(i+1)*50])) for i, size in enumerate(sizes)]
+        scores = [hdp.process_groups(groups, batched=batched) for i in range(3)]
+        return scores, hdp, groups
+
+    def test_batched(self):
+        for sizes in [[10] * 4, [5, 10, 20, 7]]:
+            s1, hdp1, groups1 = self.run_hdp(False, sizes)
+            s2, hdp2, groups2 = self.run_hdp(True, sizes)
+            self.assertTrue(np.allclose(s1, s2))
+            self.assertTrue(np.allclose(hdp1.m_mean, hdp2.m_mean))
+            self.assertTrue(np.allclose(hdp1.var_x2, hdp2.var_x2))
+            for g1, g2 in zip(groups1, groups2):
+                self.assertTrue(np.allclose(g1.m_v, g2.m_v))
+                self.assertTrue(np.allclose(g1.m_varphi, g2.m_varphi))
+
+class TestFrozenPredictor(unittest.TestCase):
+    def test_predictor(self):
+        np.random.seed(0)
+        X = np.random.randn(100, 3)
+        for mode in modes:
+            hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 100, 3, mode)
+            groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 20,
+                onlinedpgmm.ListData(X[i*50:(i+1)*50])) for i in range(2)]
+            hdp.process_groups(groups)
+            frozen = hdp.freeze(groups, 2, chunk=30)
+            self.assertTrue(np.array_equal(frozen.labels(X), hdp.predict(X)))
+            self.assertTrue(np.array_equal(frozen.labels(X, groups[1]),
+                hdp.predict(X, groups[1], 2)))
+            top = frozen.top_k(X, 3, 0)
+            self.assertTrue(np.array_equal(top[:, 0], hdp.predict(X, groups[0], 2)))
+            logpost = frozen.log_posterior(X, 0)
+            self.assertTrue(np.allclose(np.exp(logpost).sum(1), 1.0))
+            self.assertTrue(np.all(np.diff(np.take_along_axis(logpost, top, 1), axis=1) <= 0))
+            # later updates do not leak into the snapshot
+            labels = frozen.labels(X)
+            hdp.process_groups(groups)
+            self.assertTrue(np.array_equal(frozen.labels(X), labels))
+
+class TestMeanIndex(unittest.TestCase):
+    def test_labels(self):
+        np.random.seed(0)
+        centers = 10 * np.random.randn(40, 3)
+        X = centers[np.random.randint(40, size=500)] + np.random.randn(500, 3)
+        for mode in ['spherical', 'semi-spherical']:
+            dp = new_dp(mode, T=40)
+            dp.init_par(init_mean=centers.copy(), init_cov=1.0,
+                prior_x0=(1, 100) if mode == 'semi-spherical' else None)
+            frozen = dp.freeze(index=True)
+            self.assertTrue(np.array_equal(frozen.labels(X), dp.predict(X)))
+
+    def test_mode(self):
+        for mode in ['full', 'diagonal']:
+            self.assertRaises(ValueError, onlinedpgmm.MeanIndex, new_dp(mode))
+
+class TestParallel(unittest.TestCase):
+    def run_hdp(self, processes, mode='diagonal'):
+        np.random.seed(0)
+        X = np.random.randn(200, 3)
+        hdp = onlinedpgmm.OnlineHDP(6, 4, 1.0, 1.0, 0.6, 1, 200, 3, mode)
+        groups = [onlinedpgmm.Group(1.0, 4, 6, 50, 10,
+            onlinedpgmm.ListData(X[i*50:(i+1)*50])) for i in range(4)]
+        if processes > 1:
+            hdp.start_pool(processes)
+        for i in range(3):
+            hdp.process_groups(groups)
+        hdp.stop_pool()
+        return hdp, groups
+
+    def test_process_groups(self):
+        for mode in modes:
+            hdp1, groups1 = self.run_hdp(1, mode)
+            hdp2, groups2 = self.run_hdp(2, mode)
+            self.assertTrue(np.allclose(hdp1.m_mean, hdp2.m_mean))
+            for g1, g2 in zip(groups1, groups2):
+                self.assertTrue(np.allclose(g1.m_varphi, g2.m_varphi))
+                self.assertEqual(g1.update_timect, g2.update_timect)
+
+    def test_snapshot(self):
+        # full mode ships only the whitening factors to the workers
+        X = np.random.randn(50, 3)
+        dp = new_dp('full')
+        snap = dp.e_step_snapshot()
+        self.assertTrue(snap.m_cov is None and snap.m_precis is None)
+        self.assertTrue(np.array_equal(snap.E_log_gauss(X), dp.E_log_gauss(X)))
+
+if __name__ == '__main__':
+    unittest.main()